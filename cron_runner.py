@@ -1,62 +1,59 @@
+import os
 import json
-from main import read_sheet_rows, process_one_url, write_result_to_sheet, sanitize_filename
+import asyncio
+from main import read_sheet_rows, process_row, write_results_batch, use_worker_pool, log
 
-def run():
+# rows processed at once; Drive allows ~10 req/s so keep this modest
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "8"))
+
+# sheet results are flushed in batches of this many rows (one API call each)
+SHEET_FLUSH_EVERY = int(os.getenv("SHEET_FLUSH_EVERY", "20"))
+
+
+async def run():
+    use_worker_pool()
     rows = read_sheet_rows()
-    results = []
 
-    for r in rows:
-        row_index = r["row_index"]
-        base_name = r["name"]
-        urls = r["urls"]
+    # downloads/uploads are pure I/O, so rows run side by side in threads
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    pending = []
 
-        row_success = True
-        drive_links_collected = []
-        items = []
+    async def _flush():
+        batch = pending[:]
+        pending.clear()
+        try:
+            await asyncio.to_thread(write_results_batch, batch)
+        except Exception:
+            # keep the rows for the next flush; the caller decides whether
+            # the failure is fatal
+            pending.extend(batch)
+            raise
 
-        for idx, url in enumerate(urls, start=1):
-            per_link_name = base_name if idx == 1 else f"{base_name} ({idx})"
+    async def _do_row(r):
+        async with sem:
+            result = await process_row(r)
 
+        pending.append((
+            result["row_index"],
+            "\n".join(result["drive_links"]),
+            result["status"],
+        ))
+        if len(pending) >= SHEET_FLUSH_EVERY:
+            # an error here would make the TaskGroup cancel every other row,
+            # so it's left for the final flush to retry
             try:
-                uploaded, final_name = process_one_url(url, per_link_name)
-                drive_url = uploaded.get("webViewLink") or ""
-                drive_links_collected.append(drive_url)
-
-                items.append({
-                    "url": url,
-                    "filename": final_name,
-                    "success": True,
-                    "drive_file": {
-                        "id": uploaded.get("id"),
-                        "webViewLink": uploaded.get("webViewLink"),
-                        "webContentLink": uploaded.get("webContentLink"),
-                    }
-                })
+                await _flush()
             except Exception as e:
-                row_success = False
-                items.append({
-                    "url": url,
-                    "filename": sanitize_filename(per_link_name),
-                    "success": False,
-                    "error": str(e)
-                })
+                log.warning("Sheet write failed (%s), retrying after the run", e)
 
-        # ✅ mark DONE only if ALL links succeeded
-        if row_success:
-            write_result_to_sheet(row_index, "\n".join(drive_links_collected), "DONE")
-            status = "DONE"
-        else:
-            write_result_to_sheet(row_index, "\n".join(drive_links_collected), "PARTIAL")
-            status = "PARTIAL"
+        return result
 
-        results.append({
-            "row_index": row_index,
-            "name": base_name,
-            "status": status,
-            "links_count": len(urls),
-            "drive_links": drive_links_collected,
-            "items": items
-        })
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(_do_row(r)) for r in rows]
+
+    await _flush()
+
+    results = [t.result() for t in tasks]
 
     print(json.dumps({
         "success": True,
@@ -65,4 +62,10 @@ def run():
     }, ensure_ascii=False))
 
 if __name__ == "__main__":
-    run()
+    # uvloop ships with uvicorn[standard]; plain asyncio where it's missing
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+
+    (uvloop.run if uvloop else asyncio.run)(run())
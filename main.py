@@ -1,20 +1,33 @@
+import io
 import os
+import json
 import re
+import logging
+import time
+import random
 import uuid
+import shutil
+import tempfile
+import asyncio
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+import httplib2
 import requests
-import yt_dlp
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 
 # Google Drive + Sheets
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-
-# Playwright
-from playwright.sync_api import sync_playwright
+from googleapiclient.http import MediaUpload
 
 # ============== CONFIG ==============
 DRIVE_FOLDER_ID = "15slyKToMudp-SOHQx0FONS5r9HsXPE_3"
@@ -24,8 +37,74 @@ CREDS_PATH = "/etc/secrets/GOOGLE_CREDS"
 SHEET_ID = "1S9qcTJ6i3OEm_6-l2fenGmqPp_AaQJrsJTZVNUGmYv0"
 SHEET_RANGE = "videos!C2:G"     # C = name, E = link
 
+DRIVE_SCOPES = ("https://www.googleapis.com/auth/drive",)
+SHEETS_SCOPES = (
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+)
+
+# optional comma-separated allowlist, e.g. "tiktok.com,instagram.com"
+# (subdomains match too); empty accepts any http(s) link
+ALLOWED_HOSTS = tuple(
+    h.strip().lower() for h in os.getenv("ALLOWED_HOSTS", "").split(",") if h.strip()
+)
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120 Safari/537.36"
+)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(format="[%(levelname)s] %(message)s")
+log = logging.getLogger(__name__)
+log.setLevel(LOG_LEVEL)
+
+# ============== HTTP ==============
+# one keep-alive pool for page scrapes and CDN downloads
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": USER_AGENT})
+# RangedReader opens RANGE_PARTS connections per transfer to the same CDN
+# host, so the per-host pool has to cover several transfers at once
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    # throttled/flaky responses are retried too; the last one is handed
+    # back as-is so callers still see the status and decide
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False,
+    ),
+))
+
+# (connect, read): a dead host fails in seconds, a slow CDN still gets time
+HTTP_TIMEOUT = (3.05, 15)
+DOWNLOAD_TIMEOUT = (3.05, 60)
+
 # ============== FASTAPI ==============
-app = FastAPI()
+# every transfer holds a to_thread worker for its whole duration, and the
+# default pool is only min(32, cpu + 4) threads (5 on a 1-CPU instance)
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "64"))
+
+def use_worker_pool():
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="worker"))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    use_worker_pool()
+
+    global _job_queue
+    _job_queue = asyncio.Queue()  # bound to the server's event loop
+
+    workers = [asyncio.create_task(job_worker()) for _ in range(JOB_WORKERS)]
+    yield
+    for w in workers:
+        w.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -36,13 +115,78 @@ app.add_middleware(
 )
 
 class DownloadRequest(BaseModel):
-    url: str
-    filename: str | None = None
+    url: str = Field(max_length=2048)
+    filename: str | None = Field(default=None, max_length=255)
+
+    # bad links get a 422 here instead of failing deep inside yt-dlp
+    @field_validator("url")
+    @classmethod
+    def check_url(cls, v: str) -> str:
+        v = v.strip()
+        parsed = urlparse(v)
+        host = (parsed.hostname or "").lower()
+
+        if parsed.scheme not in ("http", "https") or not host:
+            raise ValueError("url must be an http(s) link")
+        if ALLOWED_HOSTS and not any(host == h or host.endswith("." + h) for h in ALLOWED_HOSTS):
+            raise ValueError(f"host {host} is not allowed")
+
+        return v
 
 class SheetDownloadRequest(BaseModel):
     limit: int | None = None  # optional for testing
 
+# Response models let FastAPI serialize straight to JSON bytes via pydantic
+class DriveFile(BaseModel):
+    id: str | None = None
+    webViewLink: str | None = None
+    webContentLink: str | None = None
+
+class DownloadResponse(BaseModel):
+    success: bool
+    filename: str
+    drive_file: DriveFile
+
+class SheetItem(BaseModel):
+    url: str
+    filename: str
+    success: bool
+    drive_file: DriveFile | None = None
+    error: str | None = None
+
+class SheetRowResult(BaseModel):
+    row_index: int
+    name: str
+    status: str
+    links_count: int
+    drive_links: list[str]
+    items: list[SheetItem]
+
+class SheetDownloadResponse(BaseModel):
+    success: bool
+    count: int
+    results: list[SheetRowResult]
+
+class JobStatus(BaseModel):
+    job_id: str
+    status: str  # queued | running | done | failed
+    filename: str | None = None
+    drive_file: DriveFile | None = None
+    error: str | None = None
+
 # ============== UTILS ==============
+_INVALID_CHARS = re.compile(r'[\\/:*?"<>|]+')
+_WS = re.compile(r"\s+")
+_AE_HOST = re.compile(r"(?:^|\.)aliexpress\.(?:com|us|ru|es)$", re.I)
+_AE_VIDEO = re.compile(r'"videoUrl":"([^"]+)"')
+_AE_VIDEO_DATA = re.compile(rb'"videoUrl":"[^"]+"')
+_AE_RUN_PARAMS = re.compile(r"window\.runParams\s*=\s*")
+_JSON_DECODER = json.JSONDecoder()
+
+def is_aliexpress(url: str) -> bool:
+    # match on the host only, a marketing link may carry "aliexpress" in its query
+    return bool(_AE_HOST.search(urlparse(url).hostname or ""))
+
 def sanitize_filename(name: str) -> str:
     """
     Cleans filename for Windows/Linux and ensures .mp4 extension.
@@ -53,10 +197,10 @@ def sanitize_filename(name: str) -> str:
     name = name.strip()
 
     # Remove invalid filesystem chars
-    name = re.sub(r'[\\/:*?"<>|]+', "_", name)
+    name = _INVALID_CHARS.sub("_", name)
 
     # Collapse spaces
-    name = re.sub(r"\s+", " ", name)
+    name = _WS.sub(" ", name)
 
     # Ensure extension
     if not name.lower().endswith(".mp4"):
@@ -65,19 +209,143 @@ def sanitize_filename(name: str) -> str:
     return name
 
 
-def get_creds(scopes):
-    return Credentials.from_service_account_file(
-        CREDS_PATH,
+@functools.lru_cache(maxsize=None)
+def _service_account_info() -> dict:
+    with open(CREDS_PATH, "r") as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def get_creds(scopes: tuple):
+    return Credentials.from_service_account_info(
+        _service_account_info(),
         scopes=scopes
     )
 
+
+# httplib2 is not thread-safe, so each worker thread builds its own client once
+_services = threading.local()
+
+def get_drive_service():
+    if not hasattr(_services, "drive"):
+        _services.drive = build(
+            "drive", "v3",
+            credentials=get_creds(DRIVE_SCOPES),
+            cache_discovery=False,
+            static_discovery=True,  # bundled discovery doc, no HTTP fetch
+        )
+    return _services.drive
+
+
+def get_sheets_service():
+    if not hasattr(_services, "sheets"):
+        _services.sheets = build(
+            "sheets", "v4",
+            credentials=get_creds(SHEETS_SCOPES),
+            cache_discovery=False,
+            static_discovery=True,
+        )
+    return _services.sheets
+
+
+# yt-dlp output is transient, so keep it in RAM (tmpfs) when there's room;
+# Docker's default /dev/shm is only 64 MB, hence the free-space guard
+TMPFS_DIR = os.getenv("TMPFS_DIR", "/dev/shm")
+TMPFS_MIN_FREE = int(os.getenv("TMPFS_MIN_FREE_MB", "1024")) * 1024 * 1024
+
+# a file's final size isn't known when it's placed, so every file still on
+# tmpfs keeps TMPFS_MIN_FREE reserved until safe_delete() releases it;
+# otherwise concurrent downloads all pass the check and fill RAM together
+_tmpfs_files: set[str] = set()
+_tmpfs_lock = threading.Lock()
+
+def temp_video_path() -> str:
+    name = f"{uuid.uuid4()}.mp4"
+
+    with _tmpfs_lock:
+        try:
+            free = shutil.disk_usage(TMPFS_DIR).free
+        except OSError:
+            free = 0
+
+        if free >= TMPFS_MIN_FREE * (len(_tmpfs_files) + 1):
+            path = os.path.join(TMPFS_DIR, name)
+            _tmpfs_files.add(path)
+            return path
+
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+def safe_delete(path: str):
+    with _tmpfs_lock:
+        _tmpfs_files.discard(path)
+
+    try:
+        os.remove(path)
+        log.debug("Deleted %s", path)
+        return
+    except FileNotFoundError:
+        return
+    except PermissionError:
+        # only Windows refuses to delete a file something still holds open
+        if os.name != "nt":
+            log.warning("Could not delete %s", path)
+            return
+    except OSError:
+        log.warning("Could not delete %s", path)
+        return
+
+    # move it out of the way and keep retrying without blocking the caller
+    pending = path + ".pending_delete"
+    try:
+        os.replace(path, pending)
+    except OSError:
+        pending = path
+
+    threading.Thread(target=_delete_later, args=(pending,), daemon=True).start()
+
+
+def _delete_later(path: str):
+    delay = 0.05
+    for _ in range(6):  # 50 ms doubling to 1.6 s, ~3 s in total
+        time.sleep(delay)
+        try:
+            os.remove(path)
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            delay *= 2
+
+    log.warning("Could not delete %s", path)
+
 # ============== GOOGLE SHEETS READ ==============
+# back-to-back /download-from-sheet or cron calls reuse one read
+SHEET_CACHE_TTL = float(os.getenv("SHEET_CACHE_TTL", "5"))
+
+_sheet_cache = {"t": 0.0, "rows": None}
+_sheet_cache_lock = threading.Lock()
+
 def read_sheet_rows() -> list[dict]:
-    creds = get_creds([
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ])
-    sheets_service = build("sheets", "v4", credentials=creds)
+    with _sheet_cache_lock:
+        if _sheet_cache["rows"] is not None and time.time() - _sheet_cache["t"] < SHEET_CACHE_TTL:
+            return list(_sheet_cache["rows"])
+
+        rows = _read_sheet_rows()
+        _sheet_cache["t"] = time.time()
+        _sheet_cache["rows"] = rows
+
+    return list(rows)
+
+
+def invalidate_sheet_cache():
+    # a writeback changes which rows are pending; the next read must see it
+    with _sheet_cache_lock:
+        _sheet_cache["rows"] = None
+
+
+def _read_sheet_rows() -> list[dict]:
+    sheets_service = get_sheets_service()
 
     resp = sheets_service.spreadsheets().values().get(
         spreadsheetId=SHEET_ID,
@@ -114,126 +382,458 @@ def read_sheet_rows() -> list[dict]:
     return rows
 
 # ============== ALIEXPRESS EXTRACTOR ==============
+# the video data sits early in the page; don't pull megabytes past it
+HTML_MAX_BYTES = 2 * 1024 * 1024
+
+def fetch_product_html(url: str) -> str:
+    """
+    Downloads the product page only until the video data has arrived.
+    """
+    buf = bytearray()
+
+    with SESSION.get(url, stream=True, timeout=HTTP_TIMEOUT) as r:
+        for chunk in r.iter_content(64 * 1024):
+            buf += chunk
+            if _has_video_data(buf) or len(buf) > HTML_MAX_BYTES:
+                break
+        encoding = r.encoding or "utf-8"
+
+    return buf.decode(encoding, errors="replace")
+
+
+def _has_video_data(buf: bytearray) -> bool:
+    # a complete, non-empty value only; "videoUrl":"" means keep reading
+    if _AE_VIDEO_DATA.search(buf):
+        return True
+
+    idx = buf.find(b"window.runParams")
+    return idx != -1 and buf.find(b"};", idx) != -1
+
+
 def extract_aliexpress_video(url: str) -> str:
-    print(f"[INFO] Extracting AliExpress video → {url}")
-
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page(
-            user_agent=(
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120 Safari/537.36"
-            )
-        )
+    log.info("Extracting AliExpress video → %s", url)
 
-        page.goto(url, timeout=60000, wait_until="networkidle")
+    # The product page ships the video URL inline, no browser needed
+    try:
+        html = fetch_product_html(url)
+        m = _AE_VIDEO.search(html)
+        video_url = m.group(1).replace("\\u002F", "/") if m else None
 
-        for _ in range(12):
-            page.evaluate("window.scrollBy(0, 1000)")
-            page.wait_for_timeout(400)
+        # an empty "videoUrl":"" doesn't mean runParams has nothing
+        if not video_url:
+            video_url = find_video_url(parse_run_params(html))
 
-        video_sources = []
+        if video_url:
+            log.info("AliExpress video found: %s", video_url)
+            return video_url
+    except requests.RequestException as e:
+        log.warning("AliExpress page fetch failed: %s", e)
+
+    log.info("videoUrl not in page HTML, falling back to Playwright")
+    return extract_aliexpress_video_browser(url)
 
-        try:
-            sources = page.query_selector_all("video source")
-            for s in sources:
-                src = s.get_attribute("src")
-                if src and src.startswith("http"):
-                    video_sources.append(src)
-        except:
-            pass
 
+def parse_run_params(html: str):
+    """
+    Decodes exactly the `window.runParams = {...}` object, no regex needed.
+    """
+    m = _AE_RUN_PARAMS.search(html)
+    if not m:
+        return None
+
+    try:
+        obj, _ = _JSON_DECODER.raw_decode(html, m.end())
+    except ValueError:
+        return None  # not strict JSON on this page
+    return obj
+
+
+def find_video_url(obj) -> str | None:
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key == "videoUrl" and isinstance(value, str) and value.startswith("http"):
+                return value
+            if key == "video" and isinstance(value, dict) and str(value.get("url", "")).startswith("http"):
+                return value["url"]
+
+            found = find_video_url(value)
+            if found:
+                return found
+
+    elif isinstance(obj, list):
+        for value in obj:
+            found = find_video_url(value)
+            if found:
+                return found
+
+    return None
+
+
+# Playwright's sync API is tied to the thread that started it, so each
+# browser lives on its own thread. Running every browser job on this small
+# pool caps how many Chromiums exist, however many workers ask for one.
+BROWSER_WORKERS = int(os.getenv("BROWSER_WORKERS", "2"))
+_browser_pool = ThreadPoolExecutor(max_workers=BROWSER_WORKERS, thread_name_prefix="browser")
+_browsers = threading.local()
+
+BLOCKED_RESOURCES = {"image", "font", "stylesheet", "media"}
+VIDEO_SELECTOR = "video[src^='http'], video source[src^='http']"
+
+def get_browser():
+    browser = getattr(_browsers, "browser", None)
+    if browser is None or not browser.is_connected():
+        # imported here so the regular path never pays for Playwright
+        from playwright.sync_api import sync_playwright
+
+        if not hasattr(_browsers, "playwright"):
+            _browsers.playwright = sync_playwright().start()
+        browser = _browsers.playwright.chromium.launch(headless=True)
+        _browsers.browser = browser
+    return browser
+
+
+def _block_heavy_resources(route):
+    if route.request.resource_type in BLOCKED_RESOURCES:
+        route.abort()
+    else:
+        route.continue_()
+
+
+def extract_aliexpress_video_browser(url: str) -> str:
+    return _browser_pool.submit(_extract_in_browser, url).result()
+
+
+def _extract_in_browser(url: str) -> str:
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+    context = get_browser().new_context(user_agent=USER_AGENT)
+
+    try:
+        page = context.new_page()
+        page.route("**/*", _block_heavy_resources)
+
+        page.goto(url, timeout=60000, wait_until="domcontentloaded")
+
+        # wait for the player itself instead of scrolling / network idle
         try:
-            videos = page.query_selector_all("video")
-            for v in videos:
-                src = v.get_attribute("src")
-                if src and src.startswith("http"):
-                    video_sources.append(src)
-        except:
+            page.wait_for_selector(VIDEO_SELECTOR, state="attached", timeout=8000)
+        except PlaywrightTimeoutError:
             pass
 
-        browser.close()
+        video_sources = page.evaluate(
+            "() => [...document.querySelectorAll('video, video source')]"
+            ".map(v => v.src || v.getAttribute('src'))"
+            ".filter(s => s && s.startsWith('http'))"
+        )
+    finally:
+        context.close()
 
-        if video_sources:
-            print(f"[OK] AliExpress video found: {video_sources[0]}")
-            return video_sources[0]
+    if video_sources:
+        log.info("AliExpress video found: %s", video_sources[0])
+        return video_sources[0]
 
-        print("[WARN] No AliExpress video found")
-        return None
+    log.warning("No AliExpress video found")
+    return None
 
 # ============== YT-DLP DOWNLOADER ==============
-def download_with_ytdlp(url: str) -> str:
-    print(f"[INFO] Downloading via yt-dlp → {url}")
-
-    tmp_outfile = f"{uuid.uuid4()}.mp4"
-
-    secret_cookie_path = "/etc/secrets/INSTAGRAM_COOKIES"
-    tmp_cookie_path = None
-
-    # copy secret cookies to /tmp because /etc/secrets is read-only
-    if os.path.exists(secret_cookie_path):
-        tmp_cookie_path = "/tmp/ig_cookies.txt"
-        with open(secret_cookie_path, "r") as src, open(tmp_cookie_path, "w") as dst:
-            dst.write(src.read())
-        print("[INFO] Copied INSTAGRAM_COOKIES to /tmp")
-
-    ydl_opts = {
-        "outtmpl": tmp_outfile,
-        "format": "mp4",
-        "quiet": False,
-        "no_warnings": False,
-        "noplaylist": True,
-    }
+# same for every download; only outtmpl/cookiefile change per call
+_YDL_BASE = {
+    "format": "mp4",
+    "quiet": False,
+    "no_warnings": False,
+    "noplaylist": True,
+    # write straight to outtmpl and never rewrite it afterwards, so the
+    # file can be uploaded while it is still growing
+    "nopart": True,
+    "fixup": "never",
+    # HLS/DASH fragments in parallel; no-op for plain mp4 files
+    "concurrent_fragment_downloads": 8,
+    "retries": 10,
+    "fragment_retries": 10,
+    "http_chunk_size": 10 * 1024 * 1024,
+    "buffersize": 64 * 1024,
+    "file_access_retries": 5,
+    # fail on the first error instead of "finishing" with no file
+    "ignoreerrors": False,
+}
+
+# Cookie files are written to /tmp once at startup: /etc/secrets is
+# read-only, and rewriting them per download could truncate a file another
+# download is reading.
+def _write_cookie_file(path: str, text: str) -> str:
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+SECRET_COOKIES_PATH = None
+if os.path.exists("/etc/secrets/INSTAGRAM_COOKIES"):
+    with open("/etc/secrets/INSTAGRAM_COOKIES", "r") as src:
+        SECRET_COOKIES_PATH = _write_cookie_file("/tmp/ig_cookies.txt", src.read())
+    log.info("Copied INSTAGRAM_COOKIES to /tmp")
+
+IG_COOKIES_PATH = None
+if os.getenv("IG_COOKIES"):
+    IG_COOKIES_PATH = _write_cookie_file("/tmp/ig_cookies_env.txt", os.environ["IG_COOKIES"])
+    log.info("Instagram cookies loaded from env var")
+
+# YoutubeDL() spends ~50 ms registering extractors, so idle instances are
+# kept per cookie file and reused. One instance is never shared by two
+# downloads at once.
+_ydl_idle: dict[str | None, list] = {}
+_ydl_lock = threading.Lock()
+
+def _take_ydl(cookiefile: str | None):
+    import yt_dlp
+
+    with _ydl_lock:
+        idle = _ydl_idle.get(cookiefile)
+        ydl = idle.pop() if idle else None
+
+    if ydl is None:
+        opts = {**_YDL_BASE, "outtmpl": ""}
+        if cookiefile:
+            opts["cookiefile"] = cookiefile
+        ydl = yt_dlp.YoutubeDL(opts)
+        ydl.add_progress_hook(functools.partial(_check_cancel, ydl))
+
+    # a failed download leaves its error code behind
+    ydl._download_retcode = 0
+    return ydl
+
+
+def _return_ydl(cookiefile: str | None, ydl):
+    ydl.cancel = None
+    with _ydl_lock:
+        _ydl_idle.setdefault(cookiefile, []).append(ydl)
+
+
+def _check_cancel(ydl, status):
+    # progress hooks fire for every block written, so a set `cancel` event
+    # stops the download within one read
+    cancel = getattr(ydl, "cancel", None)
+    if cancel is not None and cancel.is_set():
+        import yt_dlp
+        raise yt_dlp.utils.DownloadCancelled("upload failed, download cancelled")
+
+
+class SourceDownloadError(Exception):
+    """
+    The source site wouldn't give us the video (bad link, removed, blocked).
+    """
 
-    # env var cookies override
-    ig_cookies = os.getenv("IG_COOKIES")
-    if "instagram.com" in url and ig_cookies:
-        tmp_cookie_path = "/tmp/ig_cookies_env.txt"
-        with open(tmp_cookie_path, "w") as f:
-            f.write(ig_cookies)
-        print("[INFO] Instagram cookies loaded from env var")
 
-    if tmp_cookie_path:
-        ydl_opts["cookiefile"] = tmp_cookie_path
+def download_with_ytdlp(url: str, tmp_outfile: str | None = None, cancel: threading.Event | None = None) -> str:
+    # imported on first use so sheet-only / AliExpress runs skip the cost
+    import yt_dlp
 
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-    except Exception as e:
-        print("[ERROR] yt-dlp failed:", str(e))
-        return None
+    log.info("Downloading via yt-dlp → %s", url)
+
+    tmp_outfile = tmp_outfile or temp_video_path()
+
+    # env var cookies override the secret file for instagram links
+    cookiefile = SECRET_COOKIES_PATH
+    if IG_COOKIES_PATH and "instagram.com" in url:
+        cookiefile = IG_COOKIES_PATH
+
+    ydl = _take_ydl(cookiefile)
+    ydl.params["outtmpl"]["default"] = tmp_outfile
+    ydl.cancel = cancel
 
-    print(f"[OK] yt-dlp download complete → {tmp_outfile}")
+    try:
+        info = ydl.extract_info(url, download=True)
+    except yt_dlp.utils.DownloadError as e:
+        log.error("yt-dlp failed: %s", e)
+        raise SourceDownloadError(str(e)) from e
+    finally:
+        _return_ydl(cookiefile, ydl)
+
+    # an empty playlist comes back as a truthy info dict with nothing written
+    if not info or (info.get("_type") == "playlist" and not any(info.get("entries") or ())):
+        raise SourceDownloadError(f"yt-dlp found no video at {url}")
+
+    log.info("yt-dlp download complete → %s", tmp_outfile)
     return tmp_outfile
 
+
+class GrowingFileReader(io.RawIOBase):
+    """
+    Reads a file another thread is still writing. read() waits for more
+    bytes until `done` is set, then returns b"" at the real end of file.
+    """
+
+    def __init__(self, path: str, done: threading.Event, poll: float = 0.2):
+        super().__init__()
+        self._path = path
+        self._done = done
+        self._poll = poll
+        self._f = None
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while True:
+            # check before reading: an empty read after `done` is a true EOF
+            finished = self._done.is_set()
+
+            if self._f is None and os.path.exists(self._path):
+                self._f = open(self._path, "rb")
+
+            data = self._f.read(size) if self._f else b""
+            if data:
+                return data
+
+            if finished:
+                if self.error:
+                    raise self.error
+                # a missing or empty file would otherwise upload as a 0-byte video
+                if self._f is None or self._f.tell() == 0:
+                    raise SourceDownloadError("download finished without writing any data")
+                return b""
+
+            time.sleep(self._poll)
+
+    def close(self):
+        if self._f:
+            self._f.close()
+        super().close()
+
 # ============== GOOGLE DRIVE UPLOAD ==============
-def upload_to_drive(local_path, filename):
-    creds = get_creds(["https://www.googleapis.com/auth/drive"])
-    drive_service = build("drive", "v3", credentials=creds)
+# at or below this size a single multipart POST beats a resumable session.
+# A multipart body is held in memory whole, and a stream keeps up to two
+# chunks buffered, so raise these only where RAM allows.
+SMALL_UPLOAD_SIZE = int(os.getenv("SMALL_UPLOAD_MB", "5")) * 1024 * 1024
+# resumable chunk size; every PUT costs a round trip, so keep it large
+# (Drive wants a multiple of 256 KiB, which whole MiB always are)
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_MB", "16")) * 1024 * 1024
+
+class StreamUpload(MediaUpload):
+    """
+    Drive upload fed from a forward-only stream (e.g. an HTTP body).
+    MediaIoBaseUpload needs a seekable file, this only ever reads ahead.
+    Pass `size` when the length is known up front (Content-Length, ranged
+    downloads); the upload mode is then picked without reading ahead.
+    """
+
+    def __init__(self, fd, mimetype="video/mp4", chunksize=UPLOAD_CHUNK_SIZE, size=None):
+        super().__init__()
+        self._fd = fd
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        # bytearray: appends are amortised and trimming the front is cheap,
+        # where bytes would recopy the whole buffer on every partial read
+        self._buf = bytearray()
+        self._buf_start = 0
+        self._size = size
+        self._eof = False
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        # next_chunk() asks for the size before every PUT. Buffering one chunk
+        # past the upcoming one means the last PUT already carries the total,
+        # otherwise a stream ending exactly on a chunk boundary never closes.
+        if self._size is None:
+            self._fill(self._buf_start + 2 * self._chunksize + 1)
+        return self._size
+
+    def resumable(self):
+        # a stream that ends early enough goes up as one multipart request
+        if self._size is None:
+            self._fill(SMALL_UPLOAD_SIZE + 1)
+        return self._size is None or self._size > SMALL_UPLOAD_SIZE
+
+    def getbytes(self, begin, length):
+        # Drive never rewinds past the last acknowledged offset, so only the
+        # bytes from `begin` onwards have to be kept for a retried chunk
+        del self._buf[:begin - self._buf_start]
+        self._buf_start = begin
+        self._fill(begin + length)
+        return bytes(self._buf[:length])
+
+    def _fill(self, end):
+        while not self._eof and self._buf_start + len(self._buf) < end:
+            data = self._read_source(end - self._buf_start - len(self._buf))
+            if not data:
+                self._eof = True
+                have = self._buf_start + len(self._buf)
+                if self._size is None:
+                    self._size = have
+                elif have < self._size:
+                    raise SourceDownloadError(f"video stream ended at {have} of {self._size} bytes")
+                break
+            self._buf += data
+
+    def _read_source(self, size):
+        # Source failures (requests errors are IOErrors too) must not look
+        # like a dropped Drive connection: the upload loop would retry and
+        # read on past the missing bytes. SourceDownloadError isn't an OSError.
+        try:
+            return self._fd.read(size)
+        except SourceDownloadError:
+            raise
+        except Exception as e:
+            raise SourceDownloadError(f"reading the video failed: {e}") from e
+
+
+def upload_stream_to_drive(stream, filename, size=None):
+    return create_drive_file(filename, StreamUpload(stream, size=size))
+
+
+def _backoff(attempt: int, base: float = 1.0, cap: float = 30.0, jitter: float = 0.5) -> float:
+    # jitter keeps parallel uploads from retrying in lockstep after a 429 burst
+    return min(cap, base * 2 ** attempt * (1 + random.random() * jitter))
+
+
+def create_drive_file(filename, media):
+    drive_service = get_drive_service()
 
     metadata = {
         "name": filename,
         "parents": [DRIVE_FOLDER_ID]
     }
 
-    media = MediaFileUpload(local_path, mimetype="video/mp4", resumable=False)
-
-    uploaded = drive_service.files().create(
+    request = drive_service.files().create(
         body=metadata,
         media_body=media,
         fields="id,webContentLink,webViewLink",
         supportsAllDrives=True
-    ).execute()
+    )
+
+    # num_retries: the client backs off on 429/5xx itself and raises
+    # HttpError straight away for other 4xx
+    if not media.resumable():
+        return request.execute(num_retries=5)
+
+    uploaded = None
+    failures = 0
+
+    while uploaded is None:
+        try:
+            status, uploaded = request.next_chunk(num_retries=5)
+            failures = 0
+            if status:
+                log.debug("Uploading %s: %d MiB sent", filename, status.resumable_progress >> 20)
+        except (OSError, httplib2.HttpLib2Error) as e:
+            # dropped Drive connection mid-chunk: the next call asks Drive
+            # how far it got and resumes from there. Source-side failures
+            # arrive as SourceDownloadError and are not retried here.
+            failures += 1
+            if failures > 5:
+                raise
+            log.warning("Upload chunk failed (%s), retrying", e)
+            time.sleep(_backoff(failures))
 
     return uploaded
 
 # ============== SHEET WRITEBACK ==============
 def write_result_to_sheet(row_index: int, drive_links: str = "", status: str = "DONE"):
-    creds = get_creds([
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ])
-    sheets_service = build("sheets", "v4", credentials=creds)
+    sheets_service = get_sheets_service()
 
     range_to_write = f"videos!F{row_index}:G{row_index}"
 
@@ -242,58 +842,352 @@ def write_result_to_sheet(row_index: int, drive_links: str = "", status: str = "
         range=range_to_write,
         valueInputOption="RAW",
         body={"values": [[drive_links, status]]}
-    ).execute()
+    ).execute(num_retries=5)
+
+    invalidate_sheet_cache()
+
 
+def write_results_batch(updates: list[tuple[int, str, str]]):
+    """
+    Writes many (row_index, drive_links, status) results in one API call.
+    """
+    if not updates:
+        return
+
+    sheets_service = get_sheets_service()
+
+    data = [
+        {"range": f"videos!F{i}:G{i}", "values": [[links, status]]}
+        for i, links, status in updates
+    ]
+
+    sheets_service.spreadsheets().values().batchUpdate(
+        spreadsheetId=SHEET_ID,
+        body={"valueInputOption": "RAW", "data": data}
+    ).execute(num_retries=5)  # backs off on Sheets 429/5xx
+
+    invalidate_sheet_cache()
+
+
+# ============== RANGED DOWNLOAD ==============
+# CDNs throttle per connection, so big files are pulled as parallel ranges
+RANGE_PARTS = int(os.getenv("RANGE_PARTS", "8"))
+RANGE_PART_SIZE = 4 * 1024 * 1024
+
+def probe_range_length(url: str) -> int | None:
+    """
+    Returns the full size if the server honours byte ranges, else None.
+    """
+    headers = {"Range": "bytes=0-0"}
+    with SESSION.get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as r:
+        if r.status_code != 206:
+            return None
+        total = r.headers.get("Content-Range", "").rpartition("/")[2]
+
+    return int(total) if total.isdigit() else None
+
+
+class RangedReader(io.RawIOBase):
+    """
+    Downloads a URL as parallel byte ranges but hands the bytes out in
+    order, so it can feed StreamUpload like any other stream.
+    """
+
+    def __init__(self, url: str, length: int, parts: int = RANGE_PARTS, part_size: int = RANGE_PART_SIZE):
+        super().__init__()
+        self._url = url
+        self._parts = parts
+        self._ranges = deque(
+            (start, min(start + part_size, length) - 1)
+            for start in range(0, length, part_size)
+        )
+        self._inflight = deque()
+        self._pool = ThreadPoolExecutor(max_workers=parts)
+        self._buf = b""
+        self._fill_window()
+
+    def _fill_window(self):
+        # at most `parts` ranges are buffered ahead of the reader
+        while self._ranges and len(self._inflight) < self._parts:
+            start, end = self._ranges.popleft()
+            self._inflight.append(self._pool.submit(self._fetch, start, end))
+
+    def _fetch(self, start: int, end: int, attempts: int = 3) -> bytes:
+        headers = {"Range": f"bytes={start}-{end}"}
+
+        # the adapter's Retry doesn't cover a body that stalls mid-read,
+        # so a failed range is fetched again here before giving up
+        for attempt in range(attempts):
+            try:
+                r = SESSION.get(self._url, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+                if r.status_code == 206 and len(r.content) == end - start + 1:
+                    return r.content
+                error = f"HTTP {r.status_code}, {len(r.content)} of {end - start + 1} bytes"
+            except requests.RequestException as e:
+                error = e
+
+            if attempt + 1 < attempts:
+                log.warning("Range %d-%d failed (%s), retrying", start, end, error)
+                time.sleep(_backoff(attempt, base=0.5, cap=5))
+
+        raise Exception(f"Range {start}-{end} failed ({error})")
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if not self._buf:
+            if not self._inflight:
+                return b""
+            # the future is only dropped once it succeeded, so a failed range
+            # raises on every later read instead of being skipped
+            self._buf = self._inflight[0].result()
+            self._inflight.popleft()
+            self._fill_window()
+
+        if size is None or size < 0:
+            size = len(self._buf)
+
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        super().close()
 
 # ============== CORE PROCESSOR ==============
+def upload_ytdlp_to_drive(url: str, filename: str):
+    """
+    Runs yt-dlp in a background thread and uploads the file to Drive while
+    it is being written, so wall time is ~max(download, upload).
+    """
+    local_file = temp_video_path()
+    done = threading.Event()
+    cancel = threading.Event()
+    reader = GrowingFileReader(local_file, done)
+
+    def _download():
+        try:
+            download_with_ytdlp(url, local_file, cancel)
+        except Exception as e:
+            reader.error = e
+        finally:
+            done.set()
+            # the upload gave up without waiting for us, so clean up here
+            if cancel.is_set():
+                safe_delete(local_file)
+
+    worker = threading.Thread(target=_download, daemon=True)
+    worker.start()
+
+    try:
+        uploaded = upload_stream_to_drive(reader, filename)
+    except BaseException:
+        # don't hold the slot while yt-dlp finishes a video nobody will
+        # upload; the download stops at its next progress hook. cancel is
+        # set before done is checked (and done before cancel in _download),
+        # so at least one side deletes the file.
+        cancel.set()
+        reader.close()
+        if done.is_set():
+            safe_delete(local_file)
+        raise
+
+    worker.join()
+    reader.close()
+    safe_delete(local_file)
+    return uploaded
+
 def process_one_url(url: str, desired_name: str | None = None):
     url = url.strip()
-    local_file = None
 
     desired_name = sanitize_filename(desired_name or str(uuid.uuid4()))
 
-    if "aliexpress.com" in url:
+    if is_aliexpress(url):
         video_url = extract_aliexpress_video(url)
         if not video_url:
             raise Exception("AliExpress video not found")
 
-        tmp_local = f"{uuid.uuid4()}.mp4"
+        # pipe the CDN response straight into Drive, nothing touches disk
+        length = probe_range_length(video_url)
 
-        r = requests.get(video_url, stream=True, timeout=60)
-        with open(tmp_local, "wb") as f:
-            for chunk in r.iter_content(1024 * 1024):
-                f.write(chunk)
+        if length and length > RANGE_PART_SIZE:
+            with RangedReader(video_url, length) as reader:
+                uploaded = upload_stream_to_drive(reader, desired_name, size=length)
+        else:
+            with SESSION.get(video_url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                r.raise_for_status()
+                r.raw.decode_content = True
+                # Content-Length is the decoded size only when not compressed
+                length = r.headers.get("Content-Length", "")
+                if r.headers.get("Content-Encoding", "identity") != "identity" or not length.isdigit():
+                    length = None
+                uploaded = upload_stream_to_drive(r.raw, desired_name, size=length and int(length))
+
+        return uploaded, desired_name
+
+    uploaded = upload_ytdlp_to_drive(url, desired_name)
+    return uploaded, desired_name
 
-        local_file = tmp_local
+# ============== ROW PROCESSOR ==============
+# links from the same host processed at once, so one CDN isn't hammered
+PER_HOST_CONCURRENCY = int(os.getenv("PER_HOST_CONCURRENCY", "4"))
 
-    else:
-        local_file = download_with_ytdlp(url)
-        if not local_file:
-            raise Exception("yt-dlp failed")
+# every URL ends in a Drive upload, so this caps transfers across requests
+# and sheet rows alike (Drive allows ~10 writes/s per user)
+MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", "8"))
 
-    uploaded = upload_to_drive(local_file, desired_name)
+_host_sems: dict[str, asyncio.Semaphore] = {}
+_upload_sem = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
 
-    try:
-        os.remove(local_file)
-        print(f"[OK] Deleted local file")
-    except:
-        print("[WARN] Could not delete file")
+# the same link requested again while it's still running joins that run
+# instead of downloading and uploading it a second time
+_inflight: dict[tuple[str, str | None], asyncio.Task] = {}
 
-    return uploaded, desired_name
+async def process_one_url_async(url: str, desired_name: str | None = None):
+    key = (url.strip(), desired_name)
+    task = _inflight.get(key)
+
+    if task is None:
+        task = asyncio.create_task(_process_one_url_limited(url, desired_name))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+
+    # shield: one caller giving up doesn't cancel the upload for the others
+    return await asyncio.shield(task)
+
+
+async def _process_one_url_limited(url: str, desired_name: str | None = None):
+    host = urlparse(url.strip()).netloc
+    host_sem = _host_sems.setdefault(host, asyncio.Semaphore(PER_HOST_CONCURRENCY))
+
+    async with host_sem, _upload_sem:
+        return await asyncio.to_thread(process_one_url, url, desired_name)
+
+
+async def process_row(r: dict) -> dict:
+    """
+    Processes every link of one sheet row concurrently.
+    The sheet writeback is left to the caller.
+    """
+    base_name = r["name"]
+    urls = r["urls"]
+
+    # make unique filename per link in same cell
+    names = [
+        base_name if idx == 1 else f"{base_name} ({idx})"
+        for idx in range(1, len(urls) + 1)
+    ]
+
+    outcomes = await asyncio.gather(
+        *(process_one_url_async(url, name) for url, name in zip(urls, names)),
+        return_exceptions=True
+    )
+
+    row_success = True
+    drive_links_collected = []
+    items = []
+
+    for url, name, outcome in zip(urls, names, outcomes):
+        if isinstance(outcome, Exception):
+            row_success = False
+            items.append({
+                "url": url,
+                "filename": sanitize_filename(name),
+                "success": False,
+                "error": str(outcome)
+            })
+            continue
+
+        uploaded, final_name = outcome
+        drive_links_collected.append(uploaded.get("webViewLink") or "")
+
+        items.append({
+            "url": url,
+            "filename": final_name,
+            "success": True,
+            "drive_file": {
+                "id": uploaded.get("id"),
+                "webViewLink": uploaded.get("webViewLink"),
+                "webContentLink": uploaded.get("webContentLink"),
+            }
+        })
+
+    # ✅ mark DONE only if ALL links succeeded
+    return {
+        "row_index": r["row_index"],
+        "name": base_name,
+        "status": "DONE" if row_success else "PARTIAL",
+        "links_count": len(urls),
+        "drive_links": drive_links_collected,
+        "items": items
+    }
 
 # ============== MAIN ENDPOINT (single url) ==============
-@app.post("/download")
-def download_video(request: DownloadRequest):
+@app.post("/download", response_model=DownloadResponse, response_model_exclude_none=True)
+async def download_video(request: DownloadRequest):
     try:
-        uploaded, final_name = process_one_url(request.url, request.filename)
+        uploaded, final_name = await process_one_url_async(request.url, request.filename)
         return {"success": True, "filename": final_name, "drive_file": uploaded}
+    except SourceDownloadError as e:
+        # the link/source is at fault, not this service
+        raise HTTPException(status_code=502, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ============== BACKGROUND JOBS ==============
+# /download-async hands back a job id at once; workers do the transfer
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+MAX_JOBS = 1000  # finished jobs kept around for /status
+
+_jobs: dict[str, dict] = {}
+_job_queue: asyncio.Queue | None = None  # created in lifespan()
+
+async def job_worker():
+    while True:
+        job_id, url, filename = await _job_queue.get()
+        job = _jobs[job_id]
+        job["status"] = "running"
+
+        try:
+            uploaded, final_name = await process_one_url_async(url, filename)
+            job.update(status="done", filename=final_name, drive_file=uploaded)
+        except Exception as e:
+            job.update(status="failed", error=str(e))
+        finally:
+            _job_queue.task_done()
+
+
+def _forget_old_jobs():
+    # dicts keep insertion order, so the oldest jobs come first
+    for job_id in list(_jobs):
+        if len(_jobs) <= MAX_JOBS:
+            break
+        if _jobs[job_id]["status"] in ("done", "failed"):
+            del _jobs[job_id]
+
+
+@app.post("/download-async", response_model=JobStatus, response_model_exclude_none=True, status_code=202)
+async def download_video_async(request: DownloadRequest):
+    job_id = str(uuid.uuid4())
+    _jobs[job_id] = {"job_id": job_id, "status": "queued"}
+    _forget_old_jobs()
+
+    await _job_queue.put((job_id, request.url, request.filename))
+    return _jobs[job_id]
+
+
+@app.get("/status/{job_id}", response_model=JobStatus, response_model_exclude_none=True)
+async def job_status(job_id: str):
+    job = _jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return job
+
 # ============== SHEET ENDPOINT ==============
-@app.post("/download-from-sheet")
-def download_from_sheet(request: SheetDownloadRequest):
-    rows = read_sheet_rows()
+@app.post("/download-from-sheet", response_model=SheetDownloadResponse, response_model_exclude_none=True)
+async def download_from_sheet(request: SheetDownloadRequest):
+    rows = await asyncio.to_thread(read_sheet_rows)
 
     if request.limit:
         rows = rows[: request.limit]
@@ -301,68 +1195,19 @@ def download_from_sheet(request: SheetDownloadRequest):
     results = []
 
     for r in rows:
-        row_index = r["row_index"]
-        base_name = r["name"]
-        urls = r["urls"]
+        result = await process_row(r)
 
-        row_success = True
-        drive_links_collected = []
-        row_results = []
-
-        for idx, url in enumerate(urls, start=1):
-            # make unique filename per link in same cell
-            per_link_name = base_name if idx == 1 else f"{base_name} ({idx})"
+        await asyncio.to_thread(
+            write_result_to_sheet,
+            r["row_index"],
+            "\n".join(result["drive_links"]),
+            result["status"]
+        )
 
-            try:
-                uploaded, final_name = process_one_url(url, per_link_name)
-                drive_url = uploaded.get("webViewLink") or ""
-
-                drive_links_collected.append(drive_url)
-
-                row_results.append({
-                    "url": url,
-                    "filename": final_name,
-                    "success": True,
-                    "drive_file": uploaded
-                })
-
-            except Exception as e:
-                row_success = False
-                row_results.append({
-                    "url": url,
-                    "filename": sanitize_filename(per_link_name),
-                    "success": False,
-                    "error": str(e)
-                })
-
-        # ✅ after ALL links:
-        if row_success:
-            write_result_to_sheet(
-                row_index,
-                "\n".join(drive_links_collected),
-                "DONE"
-            )
-            final_status = "DONE"
-        else:
-            # some failed
-            write_result_to_sheet(
-                row_index,
-                "\n".join(drive_links_collected),
-                "PARTIAL"
-            )
-            final_status = "PARTIAL"
-
-        results.append({
-            "row_index": row_index,
-            "name": base_name,
-            "status": final_status,
-            "links_count": len(urls),
-            "drive_links": drive_links_collected,
-            "items": row_results
-        })
+        results.append(result)
 
     return {
         "success": True,
         "count": len(results),
         "results": results
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,122 @@
+"""
+Streamed Drive uploads against a fake Drive transport.
+
+Run with: python -m unittest discover tests
+"""
+import io
+import re
+import unittest
+from unittest import mock
+
+import httplib2
+import requests
+from googleapiclient.discovery import build
+
+import main
+
+MiB = 1024 * 1024
+
+
+class FakeDrive:
+    """
+    Just enough of the resumable/multipart upload protocol to see what
+    googleapiclient sends: records every PUT's Content-Range and body size.
+    """
+
+    def __init__(self):
+        self.puts = []
+        self.received = 0
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        headers = headers or {}
+
+        if method == "POST" and "uploadType=resumable" in uri:
+            return httplib2.Response({"status": "200", "location": "https://upload/session"}), b""
+        if method == "POST":
+            return httplib2.Response({"status": "200"}), b'{"id": "multipart"}'
+
+        content_range = headers.get("Content-Range") or headers.get("content-range")
+        self.puts.append((content_range, len(body or b"")))
+        self.received += len(body or b"")
+
+        m = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)", content_range)
+        if m.group(3) != "*" and int(m.group(2)) + 1 == int(m.group(3)):
+            return httplib2.Response({"status": "200"}), b'{"id": "uploaded"}'
+        return httplib2.Response({"status": "308", "range": f"bytes=0-{m.group(2)}"}), b""
+
+
+class FakeRangeSession:
+    """Serves byte ranges of `data`; ranges starting at `fail_at` time out."""
+
+    def __init__(self, data, fail_at=None):
+        self.data = data
+        self.fail_at = fail_at
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        start, end = map(int, re.match(r"bytes=(\d+)-(\d+)", headers["Range"]).groups())
+        if start == self.fail_at:
+            raise requests.exceptions.ReadTimeout("read timed out")
+
+        r = requests.Response()
+        r.status_code = 206
+        r._content = self.data[start:end + 1]
+        return r
+
+
+class FailingSource(io.RawIOBase):
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        raise OSError("source disk went away")
+
+
+class StreamUploadSourceErrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.drive = FakeDrive()
+        service = build("drive", "v3", http=self.drive, static_discovery=True)
+        patches = [
+            mock.patch.object(main, "get_drive_service", lambda: service),
+            mock.patch.object(main, "_backoff", lambda *a, **kw: 0),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_ranged_upload_completes(self):
+        data = bytes(range(256)) * (20 * MiB // 256)
+
+        with mock.patch.object(main, "SESSION", FakeRangeSession(data)):
+            with main.RangedReader("https://cdn/v.mp4", len(data)) as reader:
+                result = main.upload_stream_to_drive(reader, "v.mp4", size=len(data))
+
+        self.assertEqual(result, {"id": "uploaded"})
+        self.assertEqual(self.drive.received, len(data))
+        self.assertTrue(all(cr.endswith(f"/{len(data)}") for cr, _ in self.drive.puts))
+
+    def test_range_timeout_fails_upload_instead_of_skipping_bytes(self):
+        data = b"v" * (20 * MiB)
+        session = FakeRangeSession(data, fail_at=16 * MiB)
+
+        with mock.patch.object(main, "SESSION", session), self.assertLogs(main.log, "WARNING") as logs:
+            with main.RangedReader("https://cdn/v.mp4", len(data)) as reader:
+                with self.assertRaises(main.SourceDownloadError):
+                    main.upload_stream_to_drive(reader, "v.mp4", size=len(data))
+
+        # the source error is not mistaken for a dropped Drive connection
+        self.assertFalse(any("Upload chunk failed" in line for line in logs.output))
+        # nothing after the first full chunk reached Drive, so no file was finalised
+        self.assertEqual(self.drive.puts, [(f"bytes 0-{16 * MiB - 1}/{len(data)}", 16 * MiB)])
+
+    def test_source_oserror_is_not_retried(self):
+        with mock.patch.object(main.time, "sleep") as sleep, self.assertNoLogs(main.log, "WARNING"):
+            with self.assertRaises(main.SourceDownloadError):
+                main.upload_stream_to_drive(FailingSource(), "v.mp4")
+
+        sleep.assert_not_called()
+        self.assertEqual(self.drive.puts, [])
+
+
+if __name__ == "__main__":
+    unittest.main()